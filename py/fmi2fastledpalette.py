@@ -1,34 +1,63 @@
 import sys
-import datetime
+import os
+import shutil
+import time
+import numpy as np
 import pandas as pd
-import re
 import requests
 import xml.etree.ElementTree as et
-from io import StringIO
 import json
 
 api_url = 'https://opendata.fmi.fi/wfs'
 resample = '30min'
 rain_factor = 2  # this is 1/resample in hours, e.g. 30min->2, 10min->6, 60min->1
+session = requests.Session()
+cache_max_age = 60 * 60  # seconds
 
+# Fully qualified names of the XML elements and attributes we read from the response
+swe_field = '{http://www.opengis.net/swe/2.0}field'
+gmlcov_positions = '{http://www.opengis.net/gmlcov/1.0}positions'
+gml_tuplelist = '{http://www.opengis.net/gml/3.2}doubleOrNilReasonTupleList'
+om_observedproperty = '{http://www.opengis.net/om/2.0}observedProperty'
+xlink_href = '{http://www.w3.org/1999/xlink}href'
 
-def get_fmidata_multipointcoverage(parameters):
-    r = requests.get(f'{api_url}?{parameters}')
-    # XML root and namespaces
-    root = et.fromstring(r.text)
-    namespaces = dict([node for _, node in et.iterparse(StringIO(r.text), events=['start-ns'])])
-    # Extract name list
-    names = list(map(lambda f: f.attrib['name'], root.findall('.//swe:field', namespaces)))
-    # Extract Unix timestamps
-    timestamps = re.split(r'\s+', root.find('.//gmlcov:positions', namespaces).text)[3:-1:3]
+
+def get_fmidata(parameters, cachefile):
+    # Request data only if there is no response cached during the last hour
+    if not os.path.isfile(cachefile) or time.time() - os.path.getmtime(cachefile) > cache_max_age:
+        r = session.get(f'{api_url}?{parameters}', stream=True)
+        r.raise_for_status()
+        r.raw.decode_content = True
+        # Write to a temporary file first, so that a failed download doesn't leave a truncated cache file
+        tmpfile = '{}.{}.tmp'.format(cachefile, os.getpid())
+        try:
+            with open(tmpfile, 'wb') as f:
+                shutil.copyfileobj(r.raw, f)
+            os.replace(tmpfile, cachefile)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+    return open(cachefile, 'rb')
+
+
+def get_fmidata_multipointcoverage(parameters, cachefile):
+    names, timestamps, values, property_url = [], None, None, None
+    # Parse the response in one pass and pick only the elements we need
+    with get_fmidata(parameters, cachefile) as f:
+        for _, elem in et.iterparse(f, events=['end']):
+            if elem.tag == swe_field:  # Extract name list
+                names.append(elem.attrib['name'])
+            elif elem.tag == gmlcov_positions and timestamps is None:  # Extract Unix timestamps
+                timestamps = elem.text.split()[2::3]
+            elif elem.tag == gml_tuplelist and values is None:  # Extract data
+                values = elem.text.split()
+            elif elem.tag == om_observedproperty and property_url is None:
+                property_url = elem.attrib[xlink_href]
+            elem.clear()
     # Convert Unix timestamps to datetimes with Helsinki timezone
     datetimeindex = pd.to_datetime(sorted(timestamps * len(names)), unit='s')
     datetimeindex = datetimeindex.tz_localize(tz='UTC').tz_convert('Europe/Helsinki')
-    # Extract data
-    values = re.split(r'\s+', root.find('.//gml:doubleOrNilReasonTupleList', namespaces).text)[1:-1]
-    # Get URL for and print property explanations
-    property_url = root.find('.//om:observedProperty', namespaces).attrib[
-        '{http://www.w3.org/1999/xlink}href']
+    # Print URL for property explanations
     print(f'Properties: {property_url}')
     # Create and return DataFrame
     df = pd.DataFrame({
@@ -40,52 +69,46 @@ def get_fmidata_multipointcoverage(parameters):
     return df
 
 
-# Get geoids from https://www.geonames.org
-# geoid = 660972  # Turku, Artukainen
-latlon = '60.19,24.95'
-# List of stored queries https://ilmatieteenlaitos.fi/tallennetut-kyselyt
-query = 'fmi::forecast::hirlam::surface::point::multipointcoverage'
-df = get_fmidata_multipointcoverage(f'request=getFeature&storedquery_id={query}&latlon={latlon}&timestep=10')
-dfp = df.pivot_table(index='time', columns='name', values='value')
-rain = dfp[['Precipitation1h', 'TotalCloudCover']]
-# rain.head(50)
-rain.resample('30min').sum().head(20)
-rain16 = rain.resample('30min').sum().head(16)
-cloud16 = rain.resample('30min').mean().head(16)
-# print(rain16)
-colors = []
-readable_colors = []
-white = [100, 250, 200]
+def main():
+    # Get geoids from https://www.geonames.org
+    # geoid = 660972  # Turku, Artukainen
+    latlon = '60.19,24.95'
+    # List of stored queries https://ilmatieteenlaitos.fi/tallennetut-kyselyt
+    query = 'fmi::forecast::hirlam::surface::point::multipointcoverage'
+    cachefile = 'fmi-cache-{}.{}.xml'.format(query.replace(':', '_'), latlon)
+    df = get_fmidata_multipointcoverage(
+        f'request=getFeature&storedquery_id={query}&latlon={latlon}&timestep=10', cachefile)
+    dfp = df.pivot_table(index='time', columns='name', values='value')
+    rain = dfp[['Precipitation1h', 'TotalCloudCover']]
+    # rain.head(50)
+    rain16 = rain.resample('30min').sum().head(16)
+    cloud16 = rain.resample('30min').mean().head(16)
+    # print(rain16)
+    readable_colors = []
+    white = [100, 250, 200]
+
+    # np.round rounds like the numpy scalars did before, Python's round() differs at e.g. 0.05
+    rain_values = np.round(rain16['Precipitation1h'].to_numpy(), 1)
+    cloud_values = cloud16['TotalCloudCover'].to_numpy().astype(int)
+    # Rain colours first, then clear sky (red channel is set below) and white for cloudy
+    conditions = [rain_values >= 1.0, rain_values >= 0.2, rain_values > 0, cloud_values < 80]
+    palette = np.array([[250, 100, 0], [200, 200, 0], white, [0, 200, 200], white])
+    color_idx = np.select(conditions, range(len(conditions)), default=len(conditions))
+    colors = palette[color_idx]
+    clear = color_idx == 3
+    colors[clear, 0] = np.clip((100 - cloud_values[clear]) * 2, 0, 255)
+    colors = colors.astype(np.uint8)
+
+    for ind, curr, rain, cloud in zip(rain16.index, colors.tolist(), rain_values.tolist(), cloud_values.tolist()):
+        readable_colors.append([ind.isoformat()] + curr)
+        print(curr, ind, rain, cloud)
 
-for ind in rain16.index:
-    rain, cloud = round(rain16['Precipitation1h'][ind], 1), int(cloud16['TotalCloudCover'][ind])
-    if rain > 0:
-        if rain >= 1.0:
-            curr = [250, 100, 0]
-        elif rain >= 0.2:
-            curr = [200, 200, 0]
-        else:
-            curr = white
-        #rain_g = int(rain * rain_factor * 25) + 25
-        #if rain_g > 255:
-        #    rain_g = 255
-        #curr = [0, 0, rain_g]
-        #curr = [0, 0, rain_g]
-    elif cloud < 80:
-        # g = b = int(255 * (100 - cloud) / 100)
-        g = b = 200
-        r = int(100 - cloud) * 2
-        curr = [r, g, b]
-    else:
-        curr = white
-    colors += curr
-    readable_colors.append([ind.isoformat()] + curr)
-    print(curr, ind, rain, cloud)
+    with open(sys.argv[1], 'wb') as f:
+        f.write(colors.tobytes())
 
+    with open(sys.argv[1] + '.json', 'wt') as f:
+        f.write(json.dumps(readable_colors, indent=2))
 
-arr = bytearray(colors)
-with open(sys.argv[1], 'wb') as f:
-    f.write(arr)
 
-with open(sys.argv[1] + '.json', 'wt') as f:
-    f.write(json.dumps(readable_colors, indent=2))
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import yr2fastledpalette
+
+
+def make_forecast(start: datetime.datetime, hours: int = 60) -> dict:
+    """Create minimal hourly locationforecast response starting at start (naive UTC)."""
+    timeseries = []
+    for h in range(hours):
+        ts = start + datetime.timedelta(hours=h)
+        timeseries.append({
+            "time": ts.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "data": {
+                "instant": {"details": {"wind_speed": 3.0}},
+                "next_1_hours": {
+                    "summary": {"symbol_code": "cloudy" if h % 2 else "clearsky_day"},
+                    "details": {"precipitation_amount": h / 10, "probability_of_precipitation": 50.0},
+                },
+            },
+        })
+    return {"properties": {"timeseries": timeseries}}
+
+
+@pytest.mark.parametrize("minute", [0, 30])
+def test_forecast_fills_all_slots(minute):
+    # On a full hour the last slot is filled from the last hourly entry inside the window
+    this_halfhour = datetime.datetime(2021, 9, 14, 10, minute)
+    forecast = make_forecast(datetime.datetime(2021, 9, 14, 8))
+    fore = yr2fastledpalette.yr_precipitation_to_slots(None, forecast, "fore", this_halfhour)
+    precipitation = fore["precipitation_fore"]
+    assert len(precipitation) == 16
+    assert not np.isnan(precipitation).any()
+    # Each hourly value covers two half hour slots
+    expected = [(2 + (minute + 30 * slot) // 60) / 10 for slot in range(16)]
+    assert precipitation.tolist() == pytest.approx(expected)
+
+
+def test_create_combined_forecast_on_full_hour(monkeypatch):
+    this_halfhour = datetime.datetime(2021, 9, 14, 10, 0)
+    forecast = make_forecast(datetime.datetime(2021, 9, 14, 0))
+    monkeypatch.setattr(yr2fastledpalette, "get_first_slot", lambda: this_halfhour)
+    nowcast = {"properties": {"timeseries": []}}
+    monkeypatch.setattr(
+        yr2fastledpalette, "get_yrdata",
+        lambda args, cast_type="locationforecast": forecast if cast_type == "locationforecast" else nowcast
+    )
+    merge = yr2fastledpalette.create_combined_forecast(None)
+    assert not np.isnan(merge["precipitation_fore"]).any()
+
+
+def test_forecast_with_several_entries_per_slot():
+    # Symbols with and without _day postfix end up in the same half hour slot
+    this_halfhour = datetime.datetime(2021, 9, 14, 10, 0)
+    forecast = make_forecast(datetime.datetime(2021, 9, 14, 10))
+    for h, t in enumerate(forecast["properties"]["timeseries"]):
+        ts = this_halfhour + datetime.timedelta(minutes=15 * h)
+        t["time"] = ts.strftime("%Y-%m-%dT%H:%M:%SZ")
+    fore = yr2fastledpalette.yr_precipitation_to_slots(None, forecast, "fore", this_halfhour)
+    assert sorted(fore) == ["precipitation_fore", "probability_of_precipitation", "symbol", "wind_speed"]
+    assert fore["symbol"][:8].tolist() == ["cloudy"] * 8
@@ -1,112 +1,80 @@
 import argparse
 import datetime
-import json
 import logging
 import os
 import time
+import types
 
-import pandas as pd
+import numpy as np
+import orjson
 import pytz
 import requests
-from dateutil.parser import parse
 
 API_URL: str = "https://api.met.no/weatherapi/{}/2.0/complete"
 USER_AGENT: str = "WeatherLamp/0.2 github.com/aapris/WeatherLamp"
 
+# Reuse the same connection for nowcast and locationforecast requests
+session = requests.Session()
+session.headers.update({"User-Agent": USER_AGENT})
+
 # TODO: these should be in some configuration file
-COLOUR_CLEARSKY_NIGHT = [5, 18, 151]
-COLOUR_CLEARSKY_DAY = [20, 108, 214]
-COLOUR_PARTLYCLOUDY = [40, 158, 154]
-COLOUR_CLOUDY = [70, 200, 140]
-COLOUR_LIGHTRAIN = [90, 200, 1]
-COLOUR_LIGHTRAIN_GT50 = [110, 180, 1]
-COLOUR_RAIN = [202, 252, 1]
-COLOUR_HEAVYRAIN = [173, 133, 2]
-COLOUR_VERYHEAVYRAIN = [143, 93, 2]
+COLOUR_CLEARSKY_NIGHT = (5, 18, 151)
+COLOUR_CLEARSKY_DAY = (20, 108, 214)
+COLOUR_PARTLYCLOUDY = (40, 158, 154)
+COLOUR_CLOUDY = (70, 200, 140)
+COLOUR_LIGHTRAIN = (90, 200, 1)
+COLOUR_LIGHTRAIN_GT50 = (110, 180, 1)
+COLOUR_RAIN = (202, 252, 1)
+COLOUR_HEAVYRAIN = (173, 133, 2)
+COLOUR_VERYHEAVYRAIN = (143, 93, 2)
+
+symbolmap = types.MappingProxyType({
+    "clearsky": COLOUR_CLEARSKY_DAY,
+    "fair": COLOUR_CLEARSKY_DAY,
+    "partlycloudy": COLOUR_PARTLYCLOUDY,
+    "cloudy": COLOUR_CLOUDY,
+    "fog": COLOUR_CLOUDY,
+    "heavyrain": COLOUR_HEAVYRAIN,
+    "heavyrainandthunder": COLOUR_HEAVYRAIN,
+    "heavyrainshowers": COLOUR_HEAVYRAIN,
+    "heavyrainshowersandthunder": COLOUR_HEAVYRAIN,
+    "heavysleet": COLOUR_HEAVYRAIN,
+    "heavysleetandthunder": COLOUR_HEAVYRAIN,
+    "heavysleetshowers": COLOUR_HEAVYRAIN,
+    "heavysleetshowersandthunder": COLOUR_HEAVYRAIN,
+    "heavysnow": COLOUR_HEAVYRAIN,
+    "heavysnowandthunder": COLOUR_HEAVYRAIN,
+    "heavysnowshowers": COLOUR_HEAVYRAIN,
+    "heavysnowshowersandthunder": COLOUR_HEAVYRAIN,
+    "lightrain": COLOUR_LIGHTRAIN,
+    "lightrainandthunder": COLOUR_LIGHTRAIN,
+    "lightrainshowers": COLOUR_LIGHTRAIN,
+    "lightrainshowersandthunder": COLOUR_LIGHTRAIN,
+    "lightsleet": COLOUR_LIGHTRAIN,
+    "lightsleetandthunder": COLOUR_LIGHTRAIN,
+    "lightsleetshowers": COLOUR_LIGHTRAIN,
+    "lightsnow": COLOUR_LIGHTRAIN,
+    "lightsnowandthunder": COLOUR_LIGHTRAIN,
+    "lightsnowshowers": COLOUR_LIGHTRAIN,
+    "lightssleetshowersandthunder": COLOUR_LIGHTRAIN,
+    "lightssnowshowersandthunder": COLOUR_LIGHTRAIN,
+    "rain": COLOUR_RAIN,
+    "rainandthunder": COLOUR_RAIN,
+    "rainshowers": COLOUR_RAIN,
+    "rainshowersandthunder": COLOUR_RAIN,
+    "sleet": COLOUR_RAIN,
+    "sleetandthunder": COLOUR_RAIN,
+    "sleetshowers": COLOUR_RAIN,
+    "sleetshowersandthunder": COLOUR_RAIN,
+    "snow": COLOUR_RAIN,
+    "snowandthunder": COLOUR_RAIN,
+    "snowshowers": COLOUR_RAIN,
+    "snowshowersandthunder": COLOUR_RAIN,
+})
 
-symbolmap = {
-    **dict.fromkeys(
-        [
-            "clearsky",
-            "fair",
-        ],
-        COLOUR_CLEARSKY_DAY,
-    ),
-    **dict.fromkeys(
-        [
-            "partlycloudy",
-        ],
-        COLOUR_PARTLYCLOUDY,
-    ),
-    **dict.fromkeys(
-        [
-            "cloudy",
-            "fog",
-        ],
-        COLOUR_CLOUDY,
-    ),
-    **dict.fromkeys(
-        [
-            "heavyrain",
-            "heavyrainandthunder",
-            "heavyrainshowers",
-            "heavyrainshowersandthunder",
-            "heavysleet",
-            "heavysleetandthunder",
-            "heavysleetshowers",
-            "heavysleetshowersandthunder",
-            "heavysnow",
-            "heavysnowandthunder",
-            "heavysnowshowers",
-            "heavysnowshowersandthunder",
-        ],
-        COLOUR_HEAVYRAIN,
-    ),
-    **dict.fromkeys(
-        [
-            "lightrain",
-            "lightrainandthunder",
-            "lightrainshowers",
-            "lightrainshowersandthunder",
-            "lightsleet",
-            "lightsleetandthunder",
-            "lightsleetshowers",
-            "lightsnow",
-            "lightsnowandthunder",
-            "lightsnowshowers",
-            "lightssleetshowersandthunder",
-            "lightssnowshowersandthunder",
-        ],
-        COLOUR_LIGHTRAIN,
-    ),
-    **dict.fromkeys(
-        [
-            "rain",
-            "rainandthunder",
-            "rainshowers",
-            "rainshowersandthunder",
-        ],
-        COLOUR_RAIN,
-    ),
-    **dict.fromkeys(
-        [
-            "sleet",
-            "sleetandthunder",
-            "sleetshowers",
-            "sleetshowersandthunder",
-        ],
-        COLOUR_RAIN,
-    ),
-    **dict.fromkeys(
-        [
-            "snow",
-            "snowandthunder",
-            "snowshowers",
-            "snowshowersandthunder",
-        ],
-        COLOUR_RAIN,
-    ),
-}
+# Symbol colours as an array, so colours can be picked by symbol's index
+SYMBOL_INDEX = {symbol: i for i, symbol in enumerate(symbolmap)}
+PALETTE = np.array(list(symbolmap.values()), dtype=np.uint8)
 
 
 def parse_args() -> argparse.Namespace:
@@ -137,15 +105,14 @@ def get_yrdata(args, cast_type="locationforecast"):
     cachefile = f"yr-cache-{cast_type}.{args.lat}_{args.lon}.json"
     if os.path.isfile(cachefile):
         logging.info(f"Using cached data from {cachefile}")
-        with open(cachefile, "rt") as f:
-            yrdata = json.loads(f.read())
+        with open(cachefile, "rb") as f:
+            yrdata = orjson.loads(f.read())
     else:
         parameters = f"lat={args.lat}&lon={args.lon}"
-        headers = {"User-Agent": USER_AGENT}
         url = API_URL.format(cast_type)
         full_url = f"{url}?{parameters}"
         logging.info(f"Requesting data from {full_url}")
-        res = requests.get(full_url, headers=headers)
+        res = session.get(full_url)
         if res.status_code == 200:
             logging.info(f"Got 200 OK")
         elif res.status_code == 203:
@@ -153,107 +120,143 @@ def get_yrdata(args, cast_type="locationforecast"):
         else:
             logging.warning(f"Got {res.status_code}!")
         logging.info(f"Caching data to {cachefile}")
-        yrdata = res.json()
-        with open(cachefile, "wt") as f:
-            f.write(json.dumps(yrdata, indent=2))
+        yrdata = orjson.loads(res.content)
+        with open(cachefile, "wb") as f:
+            f.write(orjson.dumps(yrdata, option=orjson.OPT_INDENT_2))
         logging.debug(res.headers)
     return yrdata
 
 
-def add_to_dict(dict_: dict, key: str, val: float):
-    if key not in dict_:
-        dict_[key] = []
-    dict_[key].append(val)
+def parse_time(timestamp: str) -> datetime.datetime:
+    """Parse YR's ISO 8601 timestamp, e.g. 2021-09-14T14:00:00Z, much faster than dateutil's parse()."""
+    return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
+def resample_max(slots: np.ndarray, values: np.ndarray, slot_count: int) -> np.ndarray:
+    """
+    Take max of values in each time slot and fill empty slots with the previous slot's value,
+    like pandas' resample().max().fillna(method="pad") but without building DataFrames.
+
+    :param slots: sorted slot number of each value, negative for values before the first slot
+    :param values: values to aggregate
+    :param slot_count: number of slots to return
+    :return: array of slot_count values, NaN for slots outside the data's time range
+    """
+    if len(slots) == 0:
+        return np.full(slot_count, np.nan)
+    end = np.searchsorted(slots, slot_count)
+    slot_numbers, first = np.unique(slots[:end], return_index=True)
+    if values.dtype == object:
+        maxes = np.maximum.reduceat(values[:end], first)
+    else:
+        maxes = np.fmax.reduceat(values[:end], first)
+    wanted = np.arange(slot_count)
+    pos = np.searchsorted(slot_numbers, wanted, side="right") - 1
+    valid = (pos >= 0) & (wanted <= slots[-1])
+    return np.where(valid, maxes[np.clip(pos, 0, None)], np.nan)
+
+
+def get_first_slot() -> datetime.datetime:
+    """
+    Get start time of the current half hour slot.
+
+    :return: naive datetime in UTC
+    """
+    now = datetime.datetime.now(tz=pytz.UTC).replace(tzinfo=None)
+    this_halfhour = now.replace(minute=0, second=0, microsecond=0)
+    if (now - this_halfhour).total_seconds() > 30 * 60:
+        this_halfhour += datetime.timedelta(minutes=30)
+    return this_halfhour
 
 
-def yr_precipitation_to_df(args, yrdata, cast):
+def yr_precipitation_to_slots(args, yrdata, cast, this_halfhour: datetime.datetime):
     timeseries = yrdata["properties"]["timeseries"]
-    tss = []
-    pers = {}
+    # Keep only entries inside the 8 hour window and one hour around it, hourly entries before
+    # and after the window are needed to fill the first and the last slot
+    first_time = this_halfhour - datetime.timedelta(hours=1)
+    last_time = this_halfhour + datetime.timedelta(hours=8 + 1)
+    n = len(timeseries)
+    tss = np.empty(n, dtype="datetime64[s]")
+    # Preallocate arrays for all entries, they are truncated to the number of entries used
+    if cast == "now":  # nowcast has only precipitation rate
+        pers = {"precipitation_now": np.empty(n)}
+    else:  # forecast has more data available
+        pers = {
+            "precipitation_fore": np.empty(n),
+            "probability_of_precipitation": np.empty(n),
+            "symbol": np.empty(n, dtype=object),
+            "wind_speed": np.empty(n),
+        }
+    i = 0
     for t in timeseries:
+        ts = parse_time(t["time"]).replace(tzinfo=None)  # YR times are in UTC
+        if ts < first_time:
+            continue
+        if ts >= last_time:
+            break
         if cast == "now":  # nowcast has only precipitation rate
             did = t["data"]["instant"]["details"]
-            add_to_dict(pers, f"precipitation_{cast}", did["precipitation_rate"])
+            pers["precipitation_now"][i] = did["precipitation_rate"]
         elif cast == "fore":  # forecast has more data available
             if "next_1_hours" not in t["data"]:
                 break
             d1h = t["data"]["next_1_hours"]
             # Precipitation
-            add_to_dict(pers, f"precipitation_{cast}", d1h["details"]["precipitation_amount"])
-            add_to_dict(pers, "probability_of_precipitation", d1h["details"]["probability_of_precipitation"])
+            pers["precipitation_fore"][i] = d1h["details"]["precipitation_amount"]
+            pers["probability_of_precipitation"][i] = d1h["details"]["probability_of_precipitation"]
             # Weather symbol
             symbol_code = d1h["summary"]["symbol_code"]
-            if symbol_code.find("_") >= 0:  # Check for _day, _night postfix
-                symbol, variant = symbol_code.split("_")
-            else:
-                symbol, variant = symbol_code, None
-            add_to_dict(pers, "symbol_code", symbol_code)
-            add_to_dict(pers, "symbol", symbol)
-            add_to_dict(pers, "variant", variant)
+            pers["symbol"][i] = symbol_code.partition("_")[0]  # Split off _day, _night postfix
             # Wind and other forecasts
             did = t["data"]["instant"]["details"]
             # print(json.dumps(did, indent=2))
-            add_to_dict(pers, "wind_speed", did["wind_speed"])
+            pers["wind_speed"][i] = did["wind_speed"]
 
-        tss.append(parse(t["time"]))
-    df = pd.DataFrame(pers, index=tss)
-    # print(df)
-    df.index.name = "time"
-    dfr = df.resample("30min").max().fillna(method="pad")
-    now = datetime.datetime.now(tz=pytz.UTC)
-    this_halfhour = now.replace(minute=0, second=0, microsecond=0)
-    if (now - this_halfhour).total_seconds() > 30 * 60:
-        this_halfhour += datetime.timedelta(minutes=30)
-    last_halfhour = this_halfhour + datetime.timedelta(hours=8)
-    # print(this_halfhour, last_halfhour)
-    df_filtered: pd.DataFrame = dfr[(dfr.index >= this_halfhour) & (dfr.index < last_halfhour)]
-    # print(df_filtered)
-    return df_filtered
+        tss[i] = ts
+        i += 1
+    # Number of the half hour slot of each timestamp, counting from this half hour
+    slots = (tss[:i] - np.datetime64(this_halfhour)) // np.timedelta64(30, "m")
+    return {key: resample_max(slots, values[:i], 16) for key, values in pers.items()}
 
 
-def create_combined_forecast(args: argparse.Namespace) -> pd.DataFrame:
+def create_combined_forecast(args: argparse.Namespace) -> dict:
+    this_halfhour = get_first_slot()
     nowcast = get_yrdata(args, "nowcast")
-    df_now = yr_precipitation_to_df(args, nowcast, "now")
+    now = yr_precipitation_to_slots(args, nowcast, "now", this_halfhour)
 
     forecast = get_yrdata(args)
-    df_fore = yr_precipitation_to_df(args, forecast, "fore")
+    fore = yr_precipitation_to_slots(args, forecast, "fore", this_halfhour)
 
-    merge = pd.concat([df_now, df_fore], axis=1)
-    print(merge)
-    assert len(merge.index) == 16
+    merge = {**now, **fore}
+    logging.debug("%s", merge)
+    # Forecast must cover all slots, nowcast may have gaps
+    assert not np.isnan(merge["precipitation_fore"]).any()
     return merge
 
 
 def create_output(args: argparse.Namespace):
-    df = create_combined_forecast(args)
-    colors = []
-    for i in df.index:
-        # Take always nowcast's precipitation, it should be the most accurate
-        if pd.notnull(df["precipitation_now"][i]):
-            precipitation = df["precipitation_now"][i]
-        else:
-            precipitation = df["precipitation_fore"][i]
-        if precipitation >= 3.0:
-            color = COLOUR_VERYHEAVYRAIN
-        elif precipitation >= 1.5:
-            color = COLOUR_HEAVYRAIN
-        elif precipitation >= 0.5:
-            color = COLOUR_LIGHTRAIN
-        elif precipitation > 0.0 and "rain" in df["symbol"][i]:
-            color = COLOUR_LIGHTRAIN
-        elif precipitation == 0.0 and "rain" in df["symbol"][i]:
-            color = COLOUR_CLOUDY
-        else:
-            color = symbolmap[df["symbol"][i]]
-        logging.debug("{} {} {} {} {}".format(
-            precipitation, df["precipitation_now"][i], df["precipitation_fore"][i], df["symbol"][i], color)
-        )
-        colors += color + [0]
-    assert len(colors) == 64
+    forecast = create_combined_forecast(args)
+    # Take always nowcast's precipitation, it should be the most accurate
+    precipitation_now = forecast["precipitation_now"]
+    precipitation = np.where(np.isnan(precipitation_now), forecast["precipitation_fore"], precipitation_now)
+    symbols = forecast["symbol"].astype(str)
+    symbol_codes = np.array([SYMBOL_INDEX[symbol] for symbol in symbols])
+    rain = np.char.find(symbols, "rain") >= 0
+    # Start from symbol colours and override them in reverse priority order
+    colors = PALETTE[symbol_codes]
+    colors[(precipitation == 0.0) & rain] = COLOUR_CLOUDY
+    colors[(precipitation > 0.0) & rain] = COLOUR_LIGHTRAIN
+    colors[precipitation >= 0.5] = COLOUR_LIGHTRAIN
+    colors[precipitation >= 1.5] = COLOUR_HEAVYRAIN
+    colors[precipitation >= 3.0] = COLOUR_VERYHEAVYRAIN
+    logging.debug("Precipitation {} colors {}".format(precipitation.tolist(), colors.tolist()))
+    # R, G, B and a zero byte per slot
+    buf = np.zeros((len(colors), 4), dtype=np.uint8)
+    buf[:, :3] = colors
+    assert buf.size == 64
     if args.output is not None:
-        arr = bytearray(colors)
         with open(args.output, "wb") as f:
-            f.write(arr)
+            f.write(buf.data)  # Write the array's memory directly without a bytes copy
 
 
 def main():
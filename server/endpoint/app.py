@@ -1,37 +1,52 @@
-import io
-import itertools
-import json
+import asyncio
+import datetime
+import functools
 import logging
 import os
+import time
 from collections import OrderedDict
 from logging.config import dictConfig
-from typing import Tuple, Union
+from typing import Any, Awaitable, Callable, Dict, Hashable, NamedTuple, Tuple, Union
 
+import numpy as np
+import orjson
 import pandas as pd
 from starlette.applications import Starlette
 from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
 from starlette.requests import Request
-from starlette.responses import HTMLResponse, Response, StreamingResponse
+from starlette.responses import HTMLResponse, Response
 from starlette.routing import Route
 
 import yranalyzer
 import yrapiclient
 
-# TODO: check handler, perhaps not wsgi?
-dictConfig(
-    {
-        "version": 1,
-        "formatters": {
-            "default": {
-                "format": "[%(asctime)s] %(levelname)s in %(module)s: %(message)s"
-            }
-        },
-        "handlers": {
-            "wsgi": {"class": "logging.StreamHandler", "formatter": "default"}
-        },
-        "root": {"level": os.getenv("LOG_LEVEL", "INFO"), "handlers": ["wsgi"]},
-    }
-)
+
+def init_logging():
+    """
+    Configure logging and pandas display options. Called on application startup,
+    so importing this module has no side effects on global logging configuration.
+    """
+    # TODO: check handler, perhaps not wsgi?
+    dictConfig(
+        {
+            "version": 1,
+            "formatters": {
+                "default": {
+                    "format": "[%(asctime)s] %(levelname)s in %(module)s: %(message)s"
+                }
+            },
+            "handlers": {
+                "wsgi": {"class": "logging.StreamHandler", "formatter": "default"}
+            },
+            "root": {"level": os.getenv("LOG_LEVEL", "INFO"), "handlers": ["wsgi"]},
+        }
+    )
+    # Show full DataFrame in log, global pandas options are left untouched if it won't be logged
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        pd.set_option("display.max_rows", None, "display.max_columns", None, "display.width", 1000)
+
 
 # TODO: these should be in some configuration file
 
@@ -59,34 +74,179 @@ COLORMAPS["plywood"] = {
     "VERYHEAVYRAIN": [143, 93, 2],
 }
 
+# Static parts of the debug HTML page
+HTML_HEADER = """<html><head>
+        <style>
+          body {
+            margin: 0px;
+            padding: 0px;
+          }
+          .container {
+            width: 100%;
+            min-height: 100%;
+            padding: 0px;
+          }
+        </style>
+        </head><body><table class="container">
+
+<tr>
+        <td>time</td>
+        <td>yr_symbol</td>
+        <td>wl_symbol</td>
+        <td>prec</td>
+        <td>gust</td>
+        </tr>"""
+HTML_ROW = """<tr style='background-color: {formatted_color}'>
+            <td>{time}</td>
+            <td>{yr_symbol}</td>
+            <td>{wl_symbol}</td>
+            <td>{prec_nowcast}/{prec_forecast}</td>
+            <td>{wind_gust}</td>
+            </tr>"""
+HTML_FOOTER = "</table></html>"
+
+# Colormaps as uint8 DataFrames for vectorized lookup in yranalyzer.add_symbol_and_color()
+COLORMAP_FRAMES = {name: yranalyzer.colormap_to_frame(colormap) for name, colormap in COLORMAPS.items()}
+DEFAULT_COLORMAP_NAME = next(iter(COLORMAPS))
+
+
+@functools.lru_cache(maxsize=32)
+def resolve_colormap_name(colormap_name: str) -> str:
+    """
+    Return colormap_name if it exists, otherwise the default colormap's name.
+    Cached, so an unknown name is warned about only once.
+
+    :param colormap_name: requested colormap name
+    :return: existing colormap name
+    """
+    if colormap_name in COLORMAPS:
+        return colormap_name
+    logging.warning(f"Unknown colormap '{colormap_name}', using '{DEFAULT_COLORMAP_NAME}'")
+    return DEFAULT_COLORMAP_NAME
+
+
+class Args(NamedTuple):
+    """Validated query parameters, hashable so it can be used as a cache key."""
+
+    lat: float
+    lon: float
+    slot_minutes: int
+    slot_count: int
+    colormap: str
+    response_format: str
+    dev: bool
+
+
+class TTLCache:
+    """
+    Small in-process cache whose entries expire after ttl seconds.
+    Concurrent callers of get_or_create() with the same key wait for the first one to finish.
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.data: Dict[Hashable, Tuple[float, Any]] = {}
+        self.locks: Dict[Hashable, asyncio.Lock] = {}
+
+    def prune(self, now: float):
+        """
+        Remove expired entries and the oldest ones if the cache is still too big.
+
+        :param now: current time.monotonic() value
+        """
+        for key in [k for k, v in self.data.items() if now - v[0] >= self.ttl]:
+            del self.data[key]
+        while len(self.data) > self.maxsize:
+            del self.data[next(iter(self.data))]
+        for key in [k for k, v in self.locks.items() if k not in self.data and not v.locked()]:
+            del self.locks[key]
+
+    async def get_or_create(self, key: Hashable, coro_fn: Callable[[], Awaitable]) -> Any:
+        """
+        Return cached value or create it with coro_fn() if it is missing or expired.
+
+        :param key: cache key
+        :param coro_fn: function returning an awaitable which produces the value
+        :return: cached or created value
+        """
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            cached = self.data.get(key)
+            if cached is not None and now - cached[0] < self.ttl:
+                return cached[1]
+            value = await coro_fn()
+            self.data.pop(key, None)  # re-insert to keep the dict in insertion time order
+            self.data[key] = (now, value)
+            self.prune(now)
+        return value
+
+
+# Finished responses are kept for a while, YR data is cached only for 2 minutes anyway
+output_cache = TTLCache(ttl=120, maxsize=1024)
+# Parsed forecasts are shared between formats and colormaps
+forecast_cache = TTLCache(ttl=60, maxsize=256)
+
 
-def validate_args(request: Request) -> Tuple[float, float, int, int, str, str, bool]:
+def validate_args(request: Request) -> Args:
     """
     Validate query parameters.
 
     :param request: starlette.requests.Request
-    :return: lat, lon and response format
+    :return: validated arguments
     """
-    response_format = request.query_params.get("format", "bin")
-    colormap = request.query_params.get("colormap", "plain")
-    dev = True if request.query_params.get("dev") is not None else False
+    qp = request.query_params
+    response_format = qp.get("format", "bin")
+    colormap = resolve_colormap_name(qp.get("colormap", "plain"))
+    dev = True if qp.get("dev") is not None else False
     try:
-        lat = float(request.query_params.get("lat"))
-        lon = float(request.query_params.get("lon"))
+        # Round to 3 decimals (~100 m), YR's grid is much coarser and this increases cache hits
+        lat = round(float(qp.get("lat")), 3)
+        lon = round(float(qp.get("lon")), 3)
     except (ValueError, TypeError):
         raise HTTPException(status_code=400, detail="Invalid lat/lon values")
     try:
-        slot_minutes = int(request.query_params.get("interval", 30))
-        slot_count = int(request.query_params.get("slots", 16))
-        if slot_minutes / 60 * slot_count > 48:
+        slot_minutes = int(qp.get("interval", 30))
+        slot_count = int(qp.get("slots", 16))
+        if slot_minutes * slot_count > 48 * 60:  # integer comparison in minutes
             raise HTTPException(status_code=400, detail="Interval*slots > 48 hours")
     except (ValueError, TypeError):
         raise HTTPException(status_code=400, detail="Invalid interval/slots values")
-    return lat, lon, slot_minutes, slot_count, colormap, response_format, dev
+    return Args(lat, lon, slot_minutes, slot_count, colormap, response_format, dev)
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
 
 
 async def create_forecast(lat: float, lon: float, slot_minutes: int, slot_count: int,
-                          dev: bool = False) -> pd.DataFrame:
+                          dev: bool = False, now: datetime.datetime = None) -> pd.DataFrame:
+    """
+    Return a copy of cached forecast DataFrame or create it with build_forecast().
+    The copy can be modified freely.
+
+    :param lat: latitude
+    :param lon: longitude
+    :param slot_minutes:
+    :param slot_count:
+    :param dev: use local sample response data instead of remote API
+    :param now: timezone aware time used to align the slots, current time by default
+    :return: DataFrame with precipitation forecast for next slot_count of slot_minutes 16
+    """
+    if now is None:
+        now = utcnow()
+    # Entries roll over when the first slot changes
+    slot_start = yranalyzer.get_start_and_end(slot_minutes, slot_count, now)[0]
+    df = await forecast_cache.get_or_create(
+        (lat, lon, slot_minutes, slot_count, dev, slot_start),
+        lambda: build_forecast(lat, lon, slot_minutes, slot_count, dev, now)
+    )
+    return df.copy()
+
+
+async def build_forecast(lat: float, lon: float, slot_minutes: int, slot_count: int,
+                         dev: bool = False, now: datetime.datetime = None) -> pd.DataFrame:
     """
     Request YR nowcast and forecast from cache or API and create single DataFrame from the data.
 
@@ -95,11 +255,14 @@ async def create_forecast(lat: float, lon: float, slot_minutes: int, slot_count:
     :param slot_minutes:
     :param slot_count:
     :param dev: use local sample response data instead of remote API
+    :param now: timezone aware time used to align the slots, current time by default
     :return: DataFrame with precipitation forecast for next slot_count of slot_minutes 16
     """
-    nowcast = await yrapiclient.get_nowcast(lat, lon, dev)
-    forecast = await yrapiclient.get_locationforecast(lat, lon, dev)
-    df = yranalyzer.create_combined_forecast(nowcast, forecast, slot_minutes, slot_count)
+    # Requests are independent, run them concurrently
+    nowcast, forecast = await asyncio.gather(
+        yrapiclient.get_nowcast(lat, lon, dev), yrapiclient.get_locationforecast(lat, lon, dev)
+    )
+    df = yranalyzer.create_combined_forecast(nowcast, forecast, slot_minutes, slot_count, now)
     # TODO: append missing rows instead of raising exception
     assert len(df.index) == slot_count
     return df
@@ -110,7 +273,8 @@ async def create_output(
         slot_minutes: int = 30, slot_count: int = 16,
         colormap_name: str = "plain",
         output: str = None,
-        dev: bool = False) -> Union[str, bytearray]:
+        dev: bool = False,
+        now: datetime.datetime = None) -> Union[str, bytes]:
     """
     Create output in requested format.
 
@@ -122,93 +286,94 @@ async def create_output(
     :param _format: output format [html, json or bin]
     :param output: optional output file
     :param dev: use local sample response data instead of remote API
+    :param now: timezone aware time used to align the slots, current time by default
     :return: precipitation data in requested format
     """
-    df = await create_forecast(lat, lon, slot_minutes, slot_count, dev)
-    colors = []
+    df = await create_forecast(lat, lon, slot_minutes, slot_count, dev, now)
     times = []
-    if colormap_name in COLORMAPS:
-        colormap = COLORMAPS[colormap_name]
-    else:
-        colormap = COLORMAPS[list(COLORMAPS.keys())[0]]
-    cnt = 0
-    df = yranalyzer.add_symbol_and_color(df, colormap)
+    df = yranalyzer.add_symbol_and_color(df, COLORMAP_FRAMES[resolve_colormap_name(colormap_name)])
     df = yranalyzer.add_day_night(df, lat, lon)
-    pd.set_option("display.max_rows", None, "display.max_columns", None, 'display.width', 1000)
-    logging.info("\n" + str(df))
-
-    for i in df.index:
-        # Take always nowcast's precipitation, it should be the most accurate
-        if pd.notnull(df["prec_now"][i]):
-            precipitation = df["prec_now"][i]
-        else:
-            precipitation = df["prec_fore"][i]
+    # DataFrame is stringified only if INFO level is enabled
+    logging.info("\n%s", df)
+
+    # Extract columns once, indexing DataFrame per cell is slow
+    prec_now = df["prec_now"].to_numpy()
+    prec_fore = df["prec_fore"].to_numpy()
+    prob_of_prec = df["prob_of_prec"].to_numpy()
+    symbol = df["symbol"].to_numpy()
+    wl_symbol = df["wl_symbol"].to_numpy()
+    rgb = df[["r", "g", "b"]].to_numpy()
+    wind_gust = df["wind_gust"].to_numpy()
+    # Take always nowcast's precipitation, it should be the most accurate
+    precipitation = np.where(pd.notnull(prec_now), prec_now, prec_fore)
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    # Binary output (the lamp itself) needs only the colors
+    want_meta = _format in ("json", "html")
+    rgb_list = rgb.tolist() if want_meta else None
+    time_strs = df.index.astype(str).tolist() if want_meta else None
+    for k in range(len(df.index)):
+        if debug:
             logging.debug("{} {} {} {} {} {} {}".format(
-                precipitation, df["prec_now"][i], df["prec_fore"][i], df["prob_of_prec"][i], df["symbol"][i],
-                df["wl_symbol"][i], df["color"][i])
+                precipitation[k], prec_now[k], prec_fore[k], prob_of_prec[k], symbol[k], wl_symbol[k], rgb[k])
             )
-        colors += df["color"][i] + [int(df["wind_gust"][i])]  # R, G, B, wind gust speed
+        if not want_meta:
+            continue
         times.append({
-            "time": str(i),
-            "wl_symbol": df["wl_symbol"][i],
-            "yr_symbol": df["symbol"][i],
-            "prec_nowcast": df["prec_now"][i],
-            "prec_forecast": df["prec_fore"][i],
-            "prob_of_prec": df["prob_of_prec"][i],
-            "wind_gust": df["wind_gust"][i],
-            "rgb": df["color"][i]
+            "time": time_strs[k],
+            "wl_symbol": wl_symbol[k],
+            "yr_symbol": symbol[k],
+            "prec_nowcast": prec_now[k],
+            "prec_forecast": prec_fore[k],
+            "prob_of_prec": prob_of_prec[k],
+            "wind_gust": wind_gust[k],
+            "rgb": rgb_list[k]
         })
-        cnt += 1
-    assert len(colors) == slot_count * 4
-    arr = bytearray(colors)
+    # R, G, B, wind gust speed
+    # Missing gust speed is sent as 0 and values are clipped to fit in one byte
+    gust = df["wind_gust"].fillna(0).clip(0, 255).to_numpy().astype(np.uint8)
+    colors = np.concatenate([rgb, gust[:, None]], axis=1)
+    assert colors.size == slot_count * 4
     reverse = True  # TODO: add option to use reversed_arr
-    if reverse:
-        # Split list to a chunks of 4
-        split_arr = list([arr[i:i + 4] for i in range(0, len(arr), 4)])
-        # Reverse chunks
-        reversed_split_arr = list(reversed(split_arr))
-        # Join chunks back to 1-dim array
-        arr = bytearray((itertools.chain.from_iterable(reversed_split_arr)))
+    # Reversing rows keeps each 4 byte chunk in order
+    arr = colors[::-1].tobytes() if reverse else colors.tobytes()
     if output is not None:
         with open(output, "wb") as f:
             f.write(arr)
     if _format == "json":
-        return json.dumps(times, indent=2)
+        return orjson.dumps(times, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
     elif _format == "html":
-        html = ["""<html><head>
-        <style>
-          body {
-            margin: 0px;
-            padding: 0px;
-          }
-          .container {
-            width: 100%;
-            min-height: 100%;
-            padding: 0px;
-          }
-        </style>
-        </head><body><table class="container">\n""", """<tr>
-        <td>time</td>
-        <td>yr_symbol</td>
-        <td>wl_symbol</td>
-        <td>prec</td>
-        <td>gust</td>
-        </tr>"""]
-        for t in times:
-            t["formatted_color"] = "rgb({})".format(",".join([str(x) for x in t["rgb"]]))
-            html.append("""<tr style='background-color: {formatted_color}'>
-            <td>{time}</td>
-            <td>{yr_symbol}</td>
-            <td>{wl_symbol}</td>
-            <td>{prec_nowcast}/{prec_forecast}</td>
-            <td>{wind_gust}</td>
-            </tr>""".format(**t))
-        html.append("</table></html>")
+        color_strs = ["rgb({},{},{})".format(*c) for c in rgb_list]
+        html = [HTML_HEADER]
+        html += [HTML_ROW.format(formatted_color=c, **t) for t, c in zip(times, color_strs)]
+        html.append(HTML_FOOTER)
         return "\n".join(html)
     else:  # format == "bin":
         return arr
 
 
+async def get_cached_output(args: Args) -> Union[str, bytes]:
+    """
+    Return output from in-process cache or create it if it is missing or expired.
+    Concurrent requests for the same key wait for the first one to finish.
+
+    :param args: validated arguments
+    :return: precipitation data in requested format
+    """
+    now = utcnow()
+    # lat and lon are already rounded in validate_args(), entries roll over when the first slot changes
+    slot_start = yranalyzer.get_start_and_end(args.slot_minutes, args.slot_count, now)[0]
+    return await output_cache.get_or_create((args, slot_start), lambda: create_output(
+        args.lat,
+        args.lon,
+        slot_minutes=args.slot_minutes,
+        slot_count=args.slot_count,
+        colormap_name=args.colormap,
+        _format=args.response_format,
+        dev=args.dev,
+        now=now,
+    ))
+
+
 async def v1(request: Request) -> Response:
     """
     Get rain forecast from YR API and return html, json or binary response.
@@ -216,25 +381,16 @@ async def v1(request: Request) -> Response:
     :param request: starlette.requests.Request
     :return: Response
     """
-    lat, lon, slot_minutes, slot_count, colormap, response_format, dev = validate_args(
-        request
-    )
-    logging.debug(f"Requested {lat} {lon} {response_format}")
-    x = await create_output(
-        lat,
-        lon,
-        slot_minutes=slot_minutes,
-        slot_count=slot_count,
-        colormap_name=colormap,
-        _format=response_format,
-        dev=dev,
-    )
-    if response_format == "html":  # for debugging purposes
+    args = validate_args(request)
+    logging.debug(f"Requested {args.lat} {args.lon} {args.response_format}")
+    x = await get_cached_output(args)
+    if args.response_format == "html":  # for debugging purposes
         return HTMLResponse(x)
-    elif response_format == "json":  # if you want to use the data in external app
+    elif args.response_format == "json":  # if you want to use the data in external app
         return Response(x, media_type="application/json")
     else:  # for ESP8266 Weather lamp
-        return StreamingResponse(io.BytesIO(x), media_type="application/octet-stream")
+        # Not StreamingResponse, GZipMiddleware would compress it regardless of minimum_size
+        return Response(x, media_type="application/octet-stream")
 
 
 routes = [
@@ -243,4 +399,9 @@ routes = [
 
 debug = True if os.getenv("DEBUG") else False
 
-app = Starlette(debug=debug, routes=routes)
+# Compress html and json responses, small binary responses for the lamp are sent as is
+middleware = [
+    Middleware(GZipMiddleware, minimum_size=512),
+]
+
+app = Starlette(debug=debug, routes=routes, middleware=middleware, on_startup=[init_logging])
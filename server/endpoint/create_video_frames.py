@@ -1,10 +1,14 @@
 import argparse
 import datetime
+import functools
 import json
 import logging
+import os
+import re
 import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 import dateutil.parser
 import pandas as pd
@@ -13,7 +17,13 @@ from PIL import Image, ImageDraw, ImageFont
 
 import yranalyzer
 
-colormap = {
+# Testbed image names are UTC timestamps, e.g. 202109141455.png
+tb_timestamp_re = re.compile(r"(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})")
+
+# Casts of a worker process, set once per worker by init_worker()
+worker_casts: Dict[str, dict] = {}
+
+colormap = yranalyzer.colormap_to_frame({
     "CLEARSKY": [3, 3, 235],
     "PARTLYCLOUDY": [65, 126, 205],
     "CLOUDY": [180, 200, 200],
@@ -22,7 +32,7 @@ colormap = {
     "RAIN": [241, 155, 44],
     "HEAVYRAIN": [236, 94, 42],
     "VERYHEAVYRAIN": [234, 57, 248],
-}
+})
 
 
 def loop_casts(casts: list) -> dict:
@@ -53,21 +63,21 @@ def find_cast(by_start_time, ts):
 
 
 def get_cast_files(directory: Path, lat: str, lon: str) -> Tuple[list, list]:
-    entries = []
+    lat, lon = str(lat), str(lon)
     # Save only files having lat and lon in the name
-    for e in directory.iterdir():
-        if str(lat) in e.stem and str(lon) in e.stem:
-            entries.append(e)
-    entries.sort()
+    entries = [e for e in directory.iterdir() if lat in e.stem and lon in e.stem]
+    # All entries are in the same directory, so comparing names is enough
+    entries.sort(key=lambda e: e.name)
+    entries = [str(x) for x in entries]
     # Split the list to forecasts and nowcasts
-    nowcasts = [str(x) for x in entries if "nowcast" in str(x)]
-    locationforecasts = [str(x) for x in entries if "locationforecast" in str(x)]
+    nowcasts = [x for x in entries if "nowcast" in x]
+    locationforecasts = [x for x in entries if "locationforecast" in x]
     return nowcasts, locationforecasts
 
 
 def get_tb_files(directory: Path) -> List[Path]:
     entries = list(directory.iterdir())
-    entries.sort()
+    entries.sort(key=lambda e: e.name)
     return entries
 
 
@@ -89,8 +99,8 @@ def create_wl_image(df, fn=None):
     im_wl = Image.new('RGBA', (100, 480))
     draw = ImageDraw.Draw(im_wl)
     y = 0
-    for x in df.index:
-        draw.rectangle([(0, y), (100, y + 20)], tuple(df["color"][x]), width=1)
+    for rgb in df[["r", "g", "b"]].to_numpy().tolist():
+        draw.rectangle([(0, y), (100, y + 20)], tuple(rgb), width=1)
         y += 20
     # Blur image a bit by resizing it twice
     im_wl = im_wl.resize((10, 48))
@@ -101,6 +111,25 @@ def create_wl_image(df, fn=None):
     return im_wl
 
 
+@functools.lru_cache(maxsize=None)
+def get_font(size: int) -> ImageFont.FreeTypeFont:
+    """Load font once per process, it is the same for every frame."""
+    return ImageFont.truetype("/System/Library/Fonts/Supplemental/Courier New Bold.ttf", size)
+
+
+@functools.lru_cache(maxsize=None)
+def get_text_overlay(size: Tuple[int, int]) -> Image:
+    """Render texts which are the same in every frame into a transparent image.
+
+    :param size: image size
+    :return: cached Image, copy it before drawing on it
+    """
+    im_text = Image.new("RGBA", size, (255, 255, 255, 0))
+    d = ImageDraw.Draw(im_text)
+    d.text((26, 486), "testbed.fmi.fi", font=get_font(30), fill=(0, 0, 0, 100))
+    return im_text
+
+
 def create_image(fn: Path, ts: datetime.datetime, im_wl: Image, args: argparse.Namespace):
     im_width, im_height = 960, 540
     im = Image.new('RGBA', (im_width, im_height), (100, 100, 100, 255))
@@ -117,12 +146,9 @@ def create_image(fn: Path, ts: datetime.datetime, im_wl: Image, args: argparse.N
 
     # Paste original image into larger image
     im.paste(im_tb, (16, 16))
-    # Create Image for drawing texts
-    im_text = Image.new("RGBA", im.size, (255, 255, 255, 0))
-
-    # Get fonts
-    fnt_url = ImageFont.truetype("/System/Library/Fonts/Supplemental/Courier New Bold.ttf", 30)
-    fnt_time = ImageFont.truetype("/System/Library/Fonts/Supplemental/Courier New Bold.ttf", 20)
+    # Copy static texts and draw only the timestamps on it
+    im_text = get_text_overlay(im.size).copy()
+    fnt_time = get_font(20)
     # fnt = ImageFont.truetype("/System/Library/Fonts/Supplemental/Arial.ttf", 40)
     # Get a drawing context
     d = ImageDraw.Draw(im_text)
@@ -133,8 +159,6 @@ def create_image(fn: Path, ts: datetime.datetime, im_wl: Image, args: argparse.N
     # draw text, full opacity
     # d.text((10, 60), "World", font=fnt, fill=(255, 255, 255, 255))
 
-    d.text((26, 486), "testbed.fmi.fi", font=fnt_url, fill=(0, 0, 0, 100))
-
     im = Image.alpha_composite(im, im_text)
 
     # Paste original image into larger image
@@ -145,21 +169,84 @@ def create_image(fn: Path, ts: datetime.datetime, im_wl: Image, args: argparse.N
         im.save(f)
 
 
+def parse_tb_timestamp(stem: str) -> datetime.datetime:
+    """Parse timestamp from testbed image's file name without strptime's format parsing overhead.
+
+    :param stem: file name without suffix, e.g. 202109141455
+    :return: timezone aware datetime in UTC
+    """
+    m = tb_timestamp_re.fullmatch(stem)
+    if m is None:
+        raise ValueError(f"Invalid testbed image name: {stem}")
+    return datetime.datetime(*[int(x) for x in m.groups()], tzinfo=pytz.utc)
+
+
+def create_frame(tb_image: Path, nowcasts_by_start_time, forecasts_by_start_time, args):
+    ts_utc = parse_tb_timestamp(tb_image.stem)
+    ts = ts_utc.astimezone(pytz.timezone("Europe/Helsinki"))
+    ts_str = ts_utc.isoformat()
+    df = create_df(nowcasts_by_start_time, forecasts_by_start_time, ts_str, colormap, args)
+    if df is None:
+        logging.warning(f"Couldn't create dataframe at {ts}")
+        return
+    if pd.isnull(df["prec_now"][0]):
+        logging.warning(f"CHECK ME: null cell found at {ts_str}")
+    logging.info("\n%s", df)
+    im_wl = create_wl_image(df)
+    create_image(tb_image, ts, im_wl, args)
+
+
+def init_worker(log_level: str, nowcasts_by_start_time: dict, forecasts_by_start_time: dict):
+    """
+    Initialize a worker process: configure logging (spawned workers don't inherit it)
+    and store casts, so they are sent to each worker only once.
+
+    :param log_level: logging level name, e.g. INFO
+    :param nowcasts_by_start_time: nowcasts from loop_casts()
+    :param forecasts_by_start_time: locationforecasts from loop_casts()
+    """
+    init_logging(log_level)
+    worker_casts["nowcasts"] = nowcasts_by_start_time
+    worker_casts["forecasts"] = forecasts_by_start_time
+
+
+def create_worker_frame(tb_image: Path, args):
+    create_frame(tb_image, worker_casts["nowcasts"], worker_casts["forecasts"], args)
+
+
 def create_tb(tbimages, nowcasts_by_start_time, forecasts_by_start_time, args):
-    for tb_image in tbimages:
-        ts_utc = pytz.utc.localize(datetime.datetime.strptime(tb_image.stem, "%Y%m%d%H%M"))
-        ts = ts_utc.astimezone(pytz.timezone("Europe/Helsinki"))
-        ts_str = ts_utc.isoformat()
-        df = create_df(nowcasts_by_start_time, forecasts_by_start_time, ts_str, colormap, args)
-        if df is None:
-            logging.warning(f"Couldn't create dataframe at {ts}")
-            continue
-        if pd.isnull(df["prec_now"][0]):
-            logging.warning(f"CHECK ME: null cell found at {ts_str}")
-        pd.set_option("display.max_rows", None, "display.max_columns", None, 'display.width', 1000)
-        logging.info("\n" + str(df))
-        im_wl = create_wl_image(df)
-        create_image(tb_image, ts, im_wl, args)
+    # Frames are independent of each other, so render them in parallel
+    frame = functools.partial(create_worker_frame, args=args)
+    chunksize = max(1, len(tbimages) // (args.workers * 4))
+    initargs = (args.log, nowcasts_by_start_time, forecasts_by_start_time)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=initargs) as executor:
+        list(executor.map(frame, tbimages, chunksize=chunksize))
+
+
+def init_logging(log_level: str):
+    """
+    Configure logging to stderr with UTC timestamps and show full DataFrames in log.
+
+    :param log_level: logging level name, e.g. INFO
+    """
+    logging.basicConfig(level=getattr(logging, log_level), datefmt='%Y-%m-%dT%H:%M:%S',
+                        format="%(asctime)s.%(msecs)03dZ %(levelname)s %(message)s")
+    logging.Formatter.converter = time.gmtime  # Timestamps in UTC time
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        pd.set_option("display.max_rows", None, "display.max_columns", None, "display.width", 1000)
+
+
+def positive_int(value: str) -> int:
+    """
+    argparse type for integers >= 1.
+
+    :param value: command line argument
+    :return: int value
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 
 def parse_args() -> argparse.Namespace:
@@ -178,11 +265,11 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--yrdirs', required=True, nargs='+', help='Directories containing JSON files from YR API')
     parser.add_argument('--tbdirs', required=True, nargs='+',
                         help='Directories containing PNG files from testbed.fmi.fi')
+    parser.add_argument('--workers', required=False, type=positive_int, default=os.cpu_count() or 1,
+                        help='Number of worker processes rendering frames')
     # parser.add_argument('--targetdir', required=True, help='Directory to save new images')
     args = parser.parse_args()
-    logging.basicConfig(level=getattr(logging, args.log), datefmt='%Y-%m-%dT%H:%M:%S',
-                        format="%(asctime)s.%(msecs)03dZ %(levelname)s %(message)s")
-    logging.Formatter.converter = time.gmtime  # Timestamps in UTC time
+    init_logging(args.log)
     return args
 
 
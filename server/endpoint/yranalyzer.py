@@ -5,9 +5,9 @@ from typing import Union
 
 import astral
 import astral.sun
+import numpy as np
 import pandas as pd
 import pytz
-from dateutil.parser import parse
 
 # A dict to map weather symbol to particular RGB color
 
@@ -99,6 +99,17 @@ def add_to_dict(dict_: dict, key: str, val: Union[float, None]):
     dict_[key].append(val)
 
 
+def parse_time(timestamp: str) -> datetime.datetime:
+    """
+    Parse YR's ISO 8601 timestamp, e.g. 2021-09-14T14:00:00Z.
+    datetime.fromisoformat() is much faster than dateutil's generic parser.
+
+    :param timestamp: timestamp string in UTC
+    :return: timezone aware datetime
+    """
+    return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
 def get_start_and_end(slot_len: int, slot_count: int, now=None):
     """
     Calculate start and end times for given time slot length, slot count and timestamp.
@@ -143,10 +154,8 @@ def yr_precipitation_to_df(yrdata: dict, cast: str, slot_minutes: int, slot_coun
             add_to_dict(pers, "prob_of_prec", d1h["details"]["probability_of_precipitation"])
             # Weather symbol
             symbol_code = d1h["summary"]["symbol_code"]
-            if symbol_code.find("_") >= 0:  # Check for _day, _night postfix
-                symbol, variant = symbol_code.split("_")
-            else:
-                symbol, variant = symbol_code, None
+            symbol, _, variant = symbol_code.partition("_")  # Split off _day, _night postfix
+            variant = variant or None
             # add_to_dict(pers, "symbol_code", symbol_code)
             add_to_dict(pers, "symbol", symbol)
             # add_to_dict(pers, "variant", variant)
@@ -155,7 +164,7 @@ def yr_precipitation_to_df(yrdata: dict, cast: str, slot_minutes: int, slot_coun
             add_to_dict(pers, "wind_speed", did["wind_speed"])
             add_to_dict(pers, "wind_gust", did["wind_speed_of_gust"])
 
-        timestamps.append(parse(t["time"]))
+        timestamps.append(parse_time(t["time"]))
     df = pd.DataFrame(pers, index=timestamps)
     df.index.name = "time"
     res_min = f"{slot_minutes}min"
@@ -184,7 +193,7 @@ def create_combined_forecast(nowcast: dict, forecast: dict, slot_minutes: int, s
     :return: DataFrame with precipitation forecast for next slot_count of slot_minutes 16
     """
     if nowcast is None:  # create mock nowcast, if it was None
-        st, et = get_start_and_end(slot_minutes, slot_count)
+        st, et = get_start_and_end(slot_minutes, slot_count, now)
         timestamps = [st + datetime.timedelta(minutes=x * slot_minutes) for x in list(range(0, slot_count))]
         pers = {}
         for _ in list(range(0, slot_count)):
@@ -210,72 +219,74 @@ def add_day_night(df: pd.DataFrame, lat: float, lon: float):
     :param lon: longitude
     :return: enhanced DataFrame
     """
-    daynight = []
     loc = astral.LocationInfo("", "", "", lat, lon)
-    for i in df.index:
-        sun = astral.sun.sun(loc.observer, date=i)
-        if sun["sunrise"] < i < sun["sunset"]:
-            daynight.append(1)
-        else:
-            daynight.append(0)
-    df["day"] = daynight
+    # Sun times are the same for all slots of a day, calculate them once per date
+    dates = df.index.date
+    suntimes = {d: (astral.sun.sunrise(loc.observer, d), astral.sun.sunset(loc.observer, d)) for d in set(dates)}
+    sunrise = pd.DatetimeIndex([suntimes[d][0] for d in dates])
+    sunset = pd.DatetimeIndex([suntimes[d][1] for d in dates])
+    df["day"] = ((sunrise < df.index) & (df.index < sunset)).astype(int)
     return df
 
 
-def add_symbol_and_color(df: pd.DataFrame, colormap: dict):
+def colormap_to_frame(colormap: dict) -> pd.DataFrame:
+    """
+    Convert colormap dict to a DataFrame with uint8 columns r, g and b, indexed by symbol.
+
+    :param colormap: dict of symbol: [R, G, B]
+    :return: DataFrame to be passed to add_symbol_and_color()
+    """
+    return pd.DataFrame.from_dict(colormap, orient="index", columns=["r", "g", "b"]).astype(np.uint8)
+
+
+def add_symbol_and_color(df: pd.DataFrame, colormap: Union[dict, pd.DataFrame]):
     """
     Color logic happens here. Use nowcast's precipitation, when it is available and
     otherwise forecast's weather symbol (defined by YR).
 
     :param df: DataFrame containing weather data
-    :param colormap: color definitions to use
+    :param colormap: color definitions to use, preferably converted with colormap_to_frame()
     :return: enhanced DataFrame
     """
     symbols = []
-    colors = []
     rain_re = re.compile(r"rain|sleet|snow", re.IGNORECASE)
-    for i in df.index:
+    # Extract columns once, indexing DataFrame per cell is slow
+    columns = zip(
+        df["prec_now"].to_numpy(), df["prec_fore"].to_numpy(), df["prob_of_prec"].to_numpy(), df["symbol"].to_numpy()
+    )
+    for prec_now, prec_fore, prob_of_prec, symbol in columns:
         # Take always nowcast's precipitation, it should be the most accurate
-        if pd.notnull(df["prec_now"][i]):
-            precipitation = df["prec_now"][i]
+        if pd.notnull(prec_now):
+            precipitation = prec_now
             nowcast = True
         else:
-            precipitation = df["prec_fore"][i]
+            precipitation = prec_fore
             nowcast = False
-        prob_of_prec = df["prob_of_prec"][i]
         if nowcast:
             if precipitation >= 3.0:
                 colors_key = "VERYHEAVYRAIN"
-                symbols.append(colors_key)
-                colors.append(colormap[colors_key])
             elif precipitation >= 1.5:
                 colors_key = "HEAVYRAIN"
-                symbols.append(colors_key)
-                colors.append(colormap[colors_key])
             elif precipitation >= 0.5:
                 colors_key = "RAIN"
-                symbols.append(colors_key)
-                colors.append(colormap[colors_key])
             elif precipitation > 0.0:
                 colors_key = "LIGHTRAIN"
-                symbols.append(colors_key)
-                colors.append(colormap[colors_key])
-            elif precipitation == 0.0 and rain_re.findall(df["symbol"][i]):
+            elif precipitation == 0.0 and rain_re.findall(symbol):
                 colors_key = "CLOUDY"
-                symbols.append(colors_key)
-                colors.append(colormap[colors_key])
             else:
-                colors_key = symbolmap[df["symbol"][i]]
-                symbols.append(colors_key)
-                colors.append(colormap[colors_key])
+                colors_key = symbolmap[symbol]
         else:
-            symbol = df["symbol"][i]
             colors_key = symbolmap[symbol]
             if colors_key == "LIGHTRAIN":
                 if prob_of_prec <= 50:
                     colors_key = "LIGHTRAIN_LT50"
-            symbols.append(colors_key)
-            colors.append(colormap[colors_key])
+        symbols.append(colors_key)
     df["wl_symbol"] = symbols
-    df["color"] = colors
+    if isinstance(colormap, dict):
+        colormap = colormap_to_frame(colormap)
+    # Colors as uint8 columns instead of a column of [R, G, B] lists
+    rgb = colormap.loc[symbols].to_numpy()
+    df["r"] = rgb[:, 0]
+    df["g"] = rgb[:, 1]
+    df["b"] = rgb[:, 2]
     return df
@@ -1,17 +1,23 @@
+import asyncio
 import datetime
 import json
 import logging
 import pathlib
-from typing import Optional, Tuple
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
 
 import httpx
+import orjson
 import pytz as pytz
 from httpx import RequestError
 from shapely import wkt
 from shapely.geometry import Point
+from shapely.prepared import prep
 
 API_URL: str = "https://api.met.no/weatherapi/{}/2.0/complete"
 USER_AGENT: str = "WeatherLamp/0.3 github.com/aapris/WeatherLamp"
+CACHE_MAX_AGE: int = 2 * 60  # seconds
+MEMORY_CACHE_MAXSIZE: int = 256  # entries
 
 # Coverage is taken from file
 # https://api.met.no/weatherapi/nowcast/2.0/coverage.zip
@@ -27,6 +33,34 @@ nowcast_coverage_wkt = """POLYGON ((
     27.45389690417179 53.30251807369419, 
     2.547779705832076 53.30271492607023
 ))"""
+# Parse and prepare the polygon once, point-in-polygon tests are done on every request
+nowcast_coverage = prep(wkt.loads(nowcast_coverage_wkt))
+
+# Requests to YR API which are currently in progress, see single_flight()
+inflight: Dict[tuple, asyncio.Future] = {}
+# Parsed YR data in memory, {(cast_type, lat, lon): (time.monotonic() of fetch, data)}
+memory_cache: Dict[tuple, Tuple[float, dict]] = {}
+
+
+async def single_flight(key: tuple, coro_fn: Callable[[], Awaitable]):
+    """
+    Run coro_fn() only once for concurrent callers using the same key,
+    others wait for the result of the first call.
+
+    :param key: hashable key, e.g. (cast_type, lat, lon, dev)
+    :param coro_fn: function returning an awaitable
+    :return: result of coro_fn()
+    """
+    fut = inflight.get(key)
+    if fut is not None:
+        return await asyncio.shield(fut)
+    fut = asyncio.ensure_future(coro_fn())
+    inflight[key] = fut
+    try:
+        return await asyncio.shield(fut)
+    finally:
+        if inflight.get(key) is fut:
+            del inflight[key]
 
 
 async def check_cache(
@@ -52,8 +86,8 @@ async def check_cache(
             delta = 5
             ts = now.replace(minute=now.minute // 5 * 5, second=0, microsecond=0)
         cachefile = pathlib.Path(".").joinpath(pathlib.Path(f"yr-cache-{cast_type}.dev.json"))
-        with open(cachefile, "rt") as f:
-            yrdata = json.loads(f.read())
+        with open(cachefile, "rb") as f:
+            yrdata = orjson.loads(f.read())
             for t in yrdata["properties"]["timeseries"]:
                 newtime = ts.strftime("%Y-%m-%dT%H:%M:%SZ")
                 ts = ts + datetime.timedelta(minutes=delta)
@@ -66,18 +100,58 @@ async def check_cache(
             mtime = datetime.datetime.fromtimestamp(cachefile.stat().st_mtime)
             now = datetime.datetime.now()
             age = (now - mtime).total_seconds()
-            if age > 2 * 60:
+            if age > CACHE_MAX_AGE:
                 logging.info(f"Removing {cachefile} which is {age} seconds old.")
                 cachefile.unlink(missing_ok=True)
         if cachefile.exists():
             logging.info(f"Using cached data from {cachefile}.")
-            with open(cachefile, "rt") as f:
-                yrdata = json.loads(f.read())
+            with open(cachefile, "rb") as f:
+                yrdata = orjson.loads(f.read())
     return cachefile, yrdata
 
 
+def get_memory_cache(key: tuple) -> Optional[dict]:
+    """
+    Return parsed YR data from memory cache if it is not older than the file cache allows.
+
+    :param key: (cast_type, lat, lon)
+    :return: data or None
+    """
+    cached = memory_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < CACHE_MAX_AGE:
+        return cached[1]
+    return None
+
+
+def set_memory_cache(key: tuple, yrdata: dict, age: float = 0.0):
+    """
+    Store parsed YR data to memory cache and remove expired entries
+    and the oldest ones if the cache is still too big.
+
+    :param key: (cast_type, lat, lon)
+    :param yrdata: parsed data
+    :param age: seconds since the data was fetched from YR API
+    """
+    now = time.monotonic()
+    for k in [k for k, v in memory_cache.items() if now - v[0] >= CACHE_MAX_AGE]:
+        del memory_cache[k]
+    # Re-insert the key so that dict order stays oldest first
+    memory_cache.pop(key, None)
+    memory_cache[key] = (now - age, yrdata)
+    while len(memory_cache) > MEMORY_CACHE_MAXSIZE:
+        del memory_cache[next(iter(memory_cache))]
+
+
 async def get_yrdata(lat: float, lon: float, cast_type: str = "locationforecast", dev: bool = False):
+    # Memory cache avoids reading and parsing the cache file, dev mode uses always fresh sample data
+    key = (cast_type, lat, lon)
+    if not dev:
+        yrdata = get_memory_cache(key)
+        if yrdata is not None:
+            return yrdata
     cachefile, yrdata = await check_cache(lat, lon, cast_type, dev)
+    if yrdata is not None and not dev:
+        set_memory_cache(key, yrdata, time.time() - cachefile.stat().st_mtime)
     if yrdata is None:
         parameters = f"lat={lat}&lon={lon}"
         headers = {"User-Agent": USER_AGENT}
@@ -99,8 +173,8 @@ async def get_yrdata(lat: float, lon: float, cast_type: str = "locationforecast"
             logging.warning(f"Got {res.status_code}!")
         logging.info(f"Caching data to {cachefile}")
         try:
-            yrdata = json.loads(res.text)
-        except json.decoder.JSONDecodeError:
+            yrdata = orjson.loads(res.content)
+        except orjson.JSONDecodeError:
             cachefile += ".error"
         with open(cachefile, "wt") as f:
             f.write(res.text)
@@ -113,13 +187,17 @@ async def get_yrdata(lat: float, lon: float, cast_type: str = "locationforecast"
         if historyfile.exists() is False:
             with open(historyfile, "wt") as f:
                 f.write(res.text)
+        if yrdata is not None and not dev:
+            set_memory_cache(key, yrdata)
         logging.debug(res.headers)
     return yrdata
 
 
 async def get_locationforecast(lat: float, lon: float, dev: bool) -> Optional[dict]:
     if -90 < lat < 90 and -180 < lon < 180:
-        yrdata = await get_yrdata(lat, lon, "locationforecast", dev)
+        yrdata = await single_flight(
+            ("locationforecast", lat, lon, dev), lambda: get_yrdata(lat, lon, "locationforecast", dev)
+        )
     else:
         raise ValueError("Values must be '-90 < lat < 90 and -180 < lon < 180'")
     return yrdata
@@ -134,10 +212,9 @@ async def get_nowcast(lat: float, lon: float, dev: bool) -> Optional[dict]:
     :param dev: if True use local sample response data instead of remote API
     :return: response data
     """
-    nowcast_coverage = wkt.loads(nowcast_coverage_wkt)
     yrdata = None
     if nowcast_coverage.contains(Point(lon, lat)):
-        yrdata = await get_yrdata(lat, lon, "nowcast", dev)
+        yrdata = await single_flight(("nowcast", lat, lon, dev), lambda: get_yrdata(lat, lon, "nowcast", dev))
     return yrdata
 
 